@@ -7,7 +7,8 @@ Version: 1.0
 License: Apache License 2.0
 
 It is assumed that you're using pip and `requirements.txt` to manage
-dependencies, and that `pip` can be called without specifying absolute path.
+dependencies, and that the script is run with the Python interpreter (3.8+)
+the packages are installed for.
 
 USAGE:
 1. In the directory that contains `requirements.txt`, run the following command
@@ -34,14 +35,28 @@ NOTE:
 
 from __future__ import print_function
 import argparse
-import copy
+import collections
+import hashlib
+import importlib.metadata
 import json
-import ntpath
 import os
 import re
-from subprocess import Popen, PIPE
 import sys
 
+try:
+    from packaging.requirements import InvalidRequirement, Requirement
+    from packaging.utils import canonicalize_name
+except ImportError:
+    from pip._vendor.packaging.requirements import (
+        InvalidRequirement, Requirement
+    )
+    from pip._vendor.packaging.utils import canonicalize_name
+
+try:
+    import orjson  # Faster than `json`, but not required
+except ImportError:
+    orjson = None
+
 try:
     from tqdm import tqdm
 except ImportError:
@@ -49,117 +64,216 @@ except ImportError:
 
 REQUIREMENTS = os.path.join(os.getcwd(), 'requirements.txt')
 CONFIG = os.path.join(os.getcwd(), 'requirements.json')
-LINE_MATCH = re.compile(r'Requires:')
-PKG_MATCH = re.compile(r'([A-Za-z0-9-_]+)(,|$)')
+CONFIG_BASENAME = os.path.basename(CONFIG)
+CACHE = CONFIG + '.cache'
+# Same as pip, `#` starts a comment only at the beginning or after whitespace
+COMMENT_MATCH = re.compile(r'(^|\s+)#.*$')
+CONTINUATION_MATCH = re.compile(r'\\\r?\n')
+# Per-requirement options such as `--hash` follow the requirement itself
+OPTION_MATCH = re.compile(r'\s+--.*$')
+BUFFER_SIZE = 64 * 1024  # Read/write JSON file in large chunks
 # Packages installed by default wouldn't show up in requirements.txt file.
-DEFAULT_PKGS = ['setuptools', 'wheel']
+DEFAULT_PKGS = frozenset(['pip', 'setuptools', 'wheel'])
+
 
+def normalize(name):
+    """Normalize package name as in PEP 503, so each name is stored once"""
+    return sys.intern(canonicalize_name(name))
 
-def not_found(filename):
-    """Throw an exception when a file wasn't found"""
-    raise FileNotFoundError('Not found: `%s`' % ntpath.basename(filename))
+
+def json_dumps(data, pretty=False):
+    """Serialize `data` to JSON-formatted bytes"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if pretty else 0)
+    indent = 4 if pretty else None
+    return json.dumps(
+        data, indent=indent, separators=(',', ':')
+    ).encode('utf-8')
+
+
+def json_loads(data):
+    """Deserialize JSON-formatted bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def get_parents(data):
+    """Map each package to the packages that depend on it"""
+    parents = {pkg: set([]) for pkg in data}
+    for pkg_name, dependencies in data.items():
+        for dependency in dependencies:
+            parents.setdefault(dependency, set([])).add(pkg_name)
+    return parents
+
+
+def load_config():
+    """Load `requirements.json` file and the index of parents
+
+    Both are cached in a JSON file next to `requirements.json`, which is
+    reused as long as size and SHA-256 hash of `requirements.json` match.
+    """
+    with open(CONFIG, 'rb', buffering=BUFFER_SIZE) as fp:
+        raw = fp.read()
+    digest = hashlib.sha256(raw).hexdigest()
+    try:
+        with open(CACHE, 'rb', buffering=BUFFER_SIZE) as fp:
+            cache = json_loads(fp.read())
+        if cache['size'] == len(raw) and cache['sha256'] == digest:
+            parents = {
+                pkg: set(items) for pkg, items in cache['parents'].items()
+            }
+            return cache['data'], parents
+    except (OSError, ValueError, KeyError, TypeError):
+        pass  # Missing, broken or outdated cache is simply rebuilt
+
+    data = json_loads(raw)  # Parsing bytes skips decoding to str
+    data = {
+        normalize(pkg): [normalize(item) for item in dependencies]
+        for pkg, dependencies in data.items()
+    }
+    parents = get_parents(data)
+    cache = {
+        'size': len(raw),
+        'sha256': digest,
+        'data': data,
+        'parents': {pkg: sorted(items) for pkg, items in parents.items()},
+    }
+    try:
+        with open(CACHE, 'wb', buffering=BUFFER_SIZE) as fp:
+            fp.write(json_dumps(cache))
+    except OSError:  # Cache is optional, e.g. directory might be read-only
+        pass
+    return data, parents
 
 
 class Config:
 
     def __init__(self):
+        self.closures = {}  # Memoized result of `__get_closure`
         self.__get_data()
 
     def __get_data(self):
+        self.pkgs = []
         with open(REQUIREMENTS, 'r') as fp:
-            self.pkgs = [
-                line.split('==')[0].lower() for line in fp.read().splitlines() \
-                if len(line.split('==')) == 2 and \
-                '#' not in line.split('==')[0]  # Escape comments, etc.
-            ]
+            # Join lines continued with `\`, e.g. ones followed by `--hash`
+            lines = CONTINUATION_MATCH.sub(' ', fp.read()).splitlines()
+        for line in lines:
+            line = COMMENT_MATCH.sub('', line)
+            line = OPTION_MATCH.sub('', line).strip()
+            # Skip blank lines and options such as `-r` or `-e`
+            if not line or line.startswith('-'):
+                continue
+            try:
+                self.pkgs.append(normalize(Requirement(line).name))
+            except InvalidRequirement:
+                sys.stderr.write('Ignoring invalid requirement in %s: `%s`\n'
+                                 % (os.path.basename(REQUIREMENTS), line))
         self.data = {}
-        print('Executing `pip show` for every package. '
-              'This might take a while...')
-        for pkg in tqdm(self.pkgs):
-            dependencies = self.get_requirements(pkg)
+        # Scan installed distributions only once instead of per package
+        dists = {}
+        for dist in importlib.metadata.distributions():
+            if not dist.metadata['Name']:  # Skip broken installations
+                continue
+            # Same as `pip show`, the first one found on `sys.path` is used
+            dists.setdefault(normalize(dist.metadata['Name']), dist)
+        pkgs = self.pkgs
+        # Progress bar only pays off for long lists shown in a terminal
+        if sys.stderr.isatty() and len(pkgs) > 50:
+            pkgs = tqdm(pkgs)
+        for pkg in pkgs:
+            dependencies = self.get_requirements(dists.get(pkg))
             self.data[pkg] = dependencies
         return self
 
     @staticmethod
-    def get_requirements(package):
-        """Get dependencies of a given package"""
-        process = Popen(['pip', 'show', '%s' % package],
-                        stdout=PIPE,
-                        stderr=PIPE)
-        stdout, _ = process.communicate()
-        lines = stdout.splitlines()
-        for line in lines:
-            if b'Requires:' not in line:  # Each line is byte-type
+    def get_requirements(dist):
+        """Get dependencies of a given distribution"""
+        if dist is None:  # Package isn't installed
+            return None
+        dependencies = []
+        for line in dist.requires or []:
+            try:
+                requirement = Requirement(line)
+            except InvalidRequirement:
+                sys.stderr.write('Ignoring invalid requirement of `%s`: `%s`\n'
+                                 % (dist.metadata['Name'], line))
                 continue
-            matches = PKG_MATCH.findall(line.decode('utf-8'))
-            if matches is not None:
-                return [elem[0].lower() for elem in matches]
-
-    def __recursive(self, dependencies):
-        updated = False
-        data = copy.deepcopy(dependencies)
-        for elem in dependencies:
-            # Default pkgs aren't show in requirements.txt
-            if elem in DEFAULT_PKGS:
+            # Same as `pip show`, ignore dependencies only needed for extras
+            if requirement.marker is not None and \
+                    not requirement.marker.evaluate({'extra': ''}):
                 continue
-
-            result = self.data[elem]
-            if result is not None:
-                for item in result:
-                    if item not in dependencies:
-                        data.update(result)
-                        updated = True
-        return updated, data
-
-    def create_config(self):
+            name = normalize(requirement.name)
+            if name not in dependencies:
+                dependencies.append(name)
+        return dependencies
+
+    def __get_closure(self, pkg):
+        """Get every package `pkg` depends on, directly or indirectly"""
+        if pkg in self.closures:
+            return self.closures[pkg]
+        closure = set([])
+        stack = [pkg]
+        while stack:
+            elem = stack.pop()
+            for item in self.data.get(elem) or []:
+                if item in closure:
+                    continue
+                closure.add(item)
+                # Default pkgs aren't show in requirements.txt, so their own
+                # dependencies are only listed when they are `pkg` itself
+                if item in DEFAULT_PKGS:
+                    continue
+                if item in self.closures:  # Subtree was already resolved
+                    closure.update(self.closures[item])
+                else:
+                    stack.append(item)
+        closure.discard(pkg)  # In case of circular dependencies
+        self.closures[pkg] = closure
+        return closure
+
+    def create_config(self, pretty=False):
         """Create `requirements.json` file"""
+        # Resolve packages with fewer dependencies first, so that closures of
+        # their parents are mostly built from already memoized ones
+        order = sorted(self.pkgs, key=lambda p: len(self.data.get(p) or []))
+        for pkg in order:
+            self.__get_closure(pkg)
         data = {}  # Dictionary saved as JSON file later
         for pkg in self.pkgs:
-            dependencies = set(self.data[pkg])
-            while True:
-                updated, dependencies = self.__recursive(dependencies)
-                if not updated:
-                    data[pkg] = sorted(dependencies)
-                    break
-        with open(CONFIG, 'w') as fp:
-            json.dump(data, fp, indent=4, separators=(',', ':'))
-        print('%s was created.' % ntpath.basename(CONFIG))
+            data[pkg] = sorted(self.__get_closure(pkg))
+        with open(CONFIG, 'wb', buffering=BUFFER_SIZE) as fp:
+            fp.write(json_dumps(data, pretty=pretty))
+        try:
+            os.remove(CACHE)  # Built from the previous `requirements.json`
+        except OSError:
+            pass
+        print('%s was created.' % CONFIG_BASENAME)
 
 
 class Delete:
 
     def __init__(self):
-        self.data = self.__get_data()
-
-    def __get_data(self):
-        with open(CONFIG, 'r') as fp:
-            return json.load(fp)
-
-    def __get_parents(self, *args):
-        parents_pkgs = set([])
-        for pkg in args:
-            for pkg_name, dependencies in self.data.items():
-                if pkg in dependencies:
-                    parents_pkgs.add(pkg_name)
-        return parents_pkgs
-
-    def __recursive(self, *args):
-        updated = False
-        deletables = list(args)  # Packages in `args` are already ok to uninstall
-        dependencies = set([])
-        for arg in list(args):
-            if arg in DEFAULT_PKGS:
+        self.data, self.parents = load_config()
+
+    def __has_external_parent(self, pkg, excludes):
+        """Check if any package other than `excludes` depends on `pkg`"""
+        return not self.parents.get(pkg, set([])).issubset(excludes)
+
+    def __get_deletables(self, pkg):
+        """Get packages that can be uninstalled along with `pkg`"""
+        deletables = set([pkg])
+        queue = collections.deque(self.data[pkg])
+        while queue:
+            dependency = queue.popleft()
+            if dependency in DEFAULT_PKGS or dependency in deletables:
                 continue
-            dependencies.update(
-                [p for p in self.data[arg] if p not in DEFAULT_PKGS]
-            )
-        for dependency in dependencies:
-            parents = [d for d in self.__get_parents(dependency) if d not in args]
-            if not parents:
-                if dependency not in deletables:
-                    deletables.append(dependency)
-                    updated = True
-        return updated, deletables
+            # Revisited whenever one of its parents turns out to be deletable
+            if not self.__has_external_parent(dependency, deletables):
+                deletables.add(dependency)
+                queue.extend(self.data.get(dependency, []))
+        deletables.remove(pkg)
+        return deletables
 
     def delete(self, pkg):
         """Check if given package can be uninstalled"""
@@ -169,11 +283,11 @@ class Delete:
             ]
         except KeyError:
             sys.stderr.write(
-                "Package `%s` isn't in %s. " % (pkg, ntpath.basename(CONFIG)) +
+                "Package `%s` isn't in %s. " % (pkg, CONFIG_BASENAME) +
                 'Make sure the file is up to date.\n'
             )
             sys.exit(1)
-        parents = self.__get_parents(pkg)
+        parents = self.parents.get(pkg, set([]))
 
         if dependencies:
             print("Dependencies of `%s`: %s" % \
@@ -189,15 +303,7 @@ class Delete:
 
         if not dependencies:
             sys.exit(0)    # No additional package is uninstallable
-        deletable = set([])
-        while True:
-            updated, deletable = self.__recursive(*set([pkg, *deletable]))
-            if not updated:
-                break
-        if not deletable:
-            sys.exit(0)  # No additional package is uninstallable
-        deletable = set(deletable)  # Remove duplicates
-        deletable.remove(pkg)
+        deletable = self.__get_deletables(pkg)
         if deletable:
             print('Additionally, you can uninstall these packages: '
                   '%s' % ', '.join(sorted(deletable)))
@@ -205,16 +311,8 @@ class Delete:
 
 def check():
     """Lists packages that are seemingly installed by user"""
-    deletables = []
-    with open(CONFIG, 'r') as fp:
-        data = json.load(fp)
-    for pkg in data.keys():
-        count = 0
-        for _, dependencies in data.items():
-            if pkg in dependencies:
-                count += 1
-        if count == 0:
-            deletables.append(pkg)
+    data, parents = load_config()
+    deletables = [pkg for pkg in data if not parents[pkg]]
     print("Seems like you've installed these packages: "
           '%s' % ', '.join(sorted(deletables)))
 
@@ -227,6 +325,12 @@ def get_args():
         action='store_true',
         help='Create `requirements.json` file'
     )
+    parser.add_argument(
+        '--pretty',
+        action='store_true',
+        help='Indent `requirements.json` created with --config '
+             'to make it human readable'
+    )
     parser.add_argument(
         '--delete',
         type=str,
@@ -247,16 +351,17 @@ def get_args():
 
 def main():
     args = get_args()
-    if args.config:
-        assert os.path.exists(REQUIREMENTS), not_found(REQUIREMENTS)
-        print('Creating `%s` file...' % ntpath.basename(CONFIG))
-        Config().create_config()
-    if args.delete is not None:
-        assert os.path.exists(CONFIG), not_found(CONFIG)
-        Delete().delete(args.delete.lower())
-    if args.check:
-        assert os.path.exists(CONFIG), not_found(CONFIG)
-        check()
+    try:
+        if args.config:
+            print('Creating `%s` file...' % CONFIG_BASENAME)
+            Config().create_config(pretty=args.pretty)
+        if args.delete is not None:
+            Delete().delete(normalize(args.delete))
+        if args.check:
+            check()
+    except FileNotFoundError as e:
+        sys.stderr.write('Not found: `%s`\n' % os.path.basename(e.filename))
+        sys.exit(1)
 
 
 if __name__ == '__main__':